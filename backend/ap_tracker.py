@@ -3,20 +3,34 @@
 # This script runs a Flask API server and a background polling service in separate threads.
 
 import os
+import re
+import sys
 import json
+import heapq
+import mmap
 import time
+import struct
+import random
+import sqlite3
+import tempfile
+import pstats
+import cProfile
 import asyncio
 import aiohttp
 import requests
 import websockets
+from array import array
+from bisect import bisect_left
 from threading import Thread, local
 from datetime import datetime, timezone
 from functools import wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
 
 # --- Core Dependencies ---
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from waitress import serve
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, UniqueConstraint, event, or_
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, UniqueConstraint, Index, event, or_, inspect, text
 from sqlalchemy.orm import relationship, sessionmaker, declarative_base, scoped_session
 from sqlalchemy.engine import Engine
 from sqlalchemy.exc import OperationalError
@@ -32,11 +46,20 @@ from firebase_admin import credentials, messaging
 # ==============================================================================
 
 # --- Constants ---
-DATABASE_FILE = "ap_tracker.db"
+DATABASE_FILE = os.environ.get("AP_TRACKER_DATABASE", "ap_tracker.db")
 ARCHIPELAGO_HOST = "archipelago.gg"
+ARCHIPELAGO_API_URL = os.environ.get("AP_TRACKER_ARCHIPELAGO_API_URL", f"https://{ARCHIPELAGO_HOST}/api") # Overridden by load_test.py to use a local fake
 POLLING_INTERVAL_SECONDS = 60
 SUPERVISOR_INTERVAL_SECONDS = 30
+BACKFILL_BATCH_SIZE = 1000
+BACKFILL_MAX_RETRY_SECONDS = 6 * 3600 # Longest wait before retrying a room whose players could not be resolved
 FIREBASE_KEY_FILE = "service-account-key.json"
+DATAPACKAGE_STORE_DIR = "datapackages"
+DATAPACKAGE_MISS_RECHECK_SECONDS = 60 # How long a missing/unreadable store is remembered before looking again
+PROFILE_DIR = "profiles"
+PROFILING_CONFIG_FILE = "profiling.json" # Shared by the API and poller processes so profiling can be toggled at runtime
+PROFILE_MAX_RUNS = 500 # Profiling stops writing once PROFILE_DIR holds this many runs
+PROFILING_MAX_DURATION_SECONDS = 3600 # Configs set through /debug/profiling expire after at most this long
 
 # --- Create a single, robust, global HTTP session for Firebase to use ---
 retry_strategy = Retry(
@@ -127,7 +150,17 @@ class NotifiedItem(Base):
     item_id = Column(Integer, nullable=False)
     location_id = Column(Integer, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
-    __table_args__ = (UniqueConstraint('room_id', 'receiving_slot_id', 'item_id', 'location_id', name='_item_event_uc'),)
+    # Rendered when the event is saved so history reads need no upstream or datapackage lookups.
+    # Left NULL when the room's players could not be fetched; backfill_rendered_history fills them in later.
+    receiver_name = Column(String)
+    receiver_game = Column(String)
+    item_name = Column(String)
+    message = Column(String)
+    __table_args__ = (
+        UniqueConstraint('room_id', 'receiving_slot_id', 'item_id', 'location_id', name='_item_event_uc'),
+        Index('ix_notified_items_room_time', 'room_id', 'timestamp'),
+        Index('ix_notified_items_unrendered', 'room_id', sqlite_where=text('message IS NULL')),
+    )
 
 class NotifiedHint(Base):
     __tablename__ = 'notified_hints'
@@ -137,10 +170,394 @@ class NotifiedHint(Base):
     location_owner_id = Column(Integer, nullable=False)
     item_id = Column(Integer, nullable=False)
     location_id = Column(Integer, nullable=False)
-    __table_args__ = (UniqueConstraint('room_id', 'item_id', 'location_id', 'item_owner_id', 'location_owner_id', name='_hint_event_uc'),)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+    # Rendered when the event is saved so history reads need no upstream or datapackage lookups.
+    # Left NULL when the room's players could not be fetched; backfill_rendered_history fills them in later.
+    item_owner_name = Column(String)
+    location_owner_name = Column(String)
+    item_name = Column(String)
+    location_name = Column(String)
+    message = Column(String)
+    __table_args__ = (
+        UniqueConstraint('room_id', 'item_id', 'location_id', 'item_owner_id', 'location_owner_id', name='_hint_event_uc'),
+        Index('ix_notified_hints_room_time', 'room_id', 'timestamp'),
+        Index('ix_notified_hints_unrendered', 'room_id', sqlite_where=text('message IS NULL')),
+    )
+
+def migrate_schema():
+    """Adds columns and indexes introduced after a table was first created, since create_all only creates missing tables."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name): continue
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    print(f"[MAIN] Adding column {table.name}.{column.name}")
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes: index.create(engine, checkfirst=True)
+
+# --- Datapackage Store ---
+# A datapackage never changes once identified by its checksum, so setup also writes each one once to a compact file:
+#   header | sorted item ids | sorted location ids | item name offsets | location name offsets | UTF-8 string table
+# Files are opened with mmap, so all API and poller processes share one page-cache copy, and a lookup is a binary
+# search over an id array. They use native byte order: they are a local cache, not a portable format.
+DATAPACKAGE_HEADER = struct.Struct('=4sIII') # magic, item count, location count, string table size
+DATAPACKAGE_MAGIC = b'APD1'
+ENTITY_TYPES = ('item', 'location')
+_datapackage_stores = {}
+_datapackage_misses = {} # checksum -> time.monotonic() after which the file is looked for again
+
+def datapackage_store_path(checksum):
+    return os.path.join(DATAPACKAGE_STORE_DIR, f"{re.sub(r'[^A-Za-z0-9]', '', checksum)}.dpk")
+
+def write_datapackage_store(checksum, names_by_type):
+    """Writes the store file for a checksum from {'item': {id: name}, 'location': {id: name}}."""
+    sections = [sorted(names_by_type.get(entity_type, {}).items()) for entity_type in ENTITY_TYPES]
+    strings, offsets = bytearray(), []
+    for entries in sections:
+        section_offsets = array('I')
+        for _, name in entries:
+            section_offsets.append(len(strings))
+            strings += name.encode()
+        section_offsets.append(len(strings))
+        offsets.append(section_offsets)
+
+    path = datapackage_store_path(checksum)
+    os.makedirs(DATAPACKAGE_STORE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(DATAPACKAGE_HEADER.pack(DATAPACKAGE_MAGIC, len(sections[0]), len(sections[1]), len(strings)))
+        for entries in sections: f.write(array('q', [eid for eid, _ in entries]).tobytes())
+        for section_offsets in offsets: f.write(section_offsets.tobytes())
+        f.write(strings)
+    os.replace(tmp_path, path) # Readers only ever see a complete file
+    _datapackage_stores.pop(checksum, None)
+    _datapackage_misses.pop(checksum, None)
+
+def write_datapackage_store_from_cache(session, game, checksum):
+    """Writes the store file for a checksum from its rows in datapackage_cache."""
+    names_by_type = {entity_type: {} for entity_type in ENTITY_TYPES}
+    for entity_type, eid, name in session.query(DatapackageCache.entity_type, DatapackageCache.entity_id, DatapackageCache.entity_name).filter_by(game=game, checksum=checksum):
+        names_by_type[entity_type][eid] = name
+    write_datapackage_store(checksum, names_by_type)
+
+def build_missing_datapackage_stores():
+    """Writes a store for every cached datapackage that has no readable file yet (e.g. cached before stores existed)."""
+    session = Session()
+    try:
+        pairs = session.query(DatapackageCache.game, DatapackageCache.checksum).distinct().all()
+        built = 0
+        for game, checksum in pairs:
+            if get_datapackage_store(checksum) is not None: continue
+            write_datapackage_store_from_cache(session, game, checksum)
+            built += 1
+        if built: print(f"[DATAPACKAGE] Built {built} missing datapackage store(s).")
+    finally:
+        Session.remove()
+
+class DatapackageStore:
+    """Read-only, memory-mapped view of one datapackage store file."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, item_count, location_count, strings_size = DATAPACKAGE_HEADER.unpack_from(self.mm)
+        counts = dict(zip(ENTITY_TYPES, (item_count, location_count)))
+        if magic != DATAPACKAGE_MAGIC: raise ValueError(f"{path} is not a datapackage store")
+        if len(self.mm) != DATAPACKAGE_HEADER.size + 12 * (item_count + location_count) + 8 + strings_size:
+            raise ValueError(f"{path} is truncated or corrupt")
+
+        view, pos = memoryview(self.mm), DATAPACKAGE_HEADER.size
+        ids = {}
+        for entity_type in ENTITY_TYPES:
+            ids[entity_type] = view[pos:pos + 8 * counts[entity_type]].cast('q')
+            pos += 8 * counts[entity_type]
+        self.sections = {}
+        for entity_type in ENTITY_TYPES:
+            self.sections[entity_type] = (ids[entity_type], view[pos:pos + 4 * (counts[entity_type] + 1)].cast('I'))
+            pos += 4 * (counts[entity_type] + 1)
+        self.strings_start = pos
+
+    def lookup(self, entity_type, entity_id):
+        ids, offsets = self.sections[entity_type]
+        i = bisect_left(ids, entity_id)
+        if i == len(ids) or ids[i] != entity_id: return None
+        return self.mm[self.strings_start + offsets[i]:self.strings_start + offsets[i + 1]].decode()
+
+def get_datapackage_store(checksum):
+    """Returns the mapped store for a checksum, or None if it has not been written (yet)."""
+    if not checksum: return None
+    if (store := _datapackage_stores.get(checksum)) is None:
+        if time.monotonic() < _datapackage_misses.get(checksum, 0): return None
+        try:
+            store = DatapackageStore(datapackage_store_path(checksum))
+        except FileNotFoundError:
+            # Not written yet: setup may write it later, possibly from another process
+            _datapackage_misses[checksum] = time.monotonic() + DATAPACKAGE_MISS_RECHECK_SECONDS
+            return None
+        except (OSError, ValueError, struct.error) as e:
+            print(f"[DATAPACKAGE] Could not open store for checksum {checksum[:8]}... Error: {e}")
+            _datapackage_misses[checksum] = time.monotonic() + DATAPACKAGE_MISS_RECHECK_SECONDS
+            return None
+        _datapackage_stores[checksum] = store
+    return store
+
+# --- History Rendering ---
+def lookup_entity_name(session, game, checksum, entity_type, entity_id):
+    if store := get_datapackage_store(checksum):
+        return store.lookup(entity_type, entity_id) or f"ID {entity_id}"
+    # Datapackages cached before the store existed, until setup writes their file
+    return session.query(DatapackageCache.entity_name).filter_by(game=game, checksum=checksum, entity_type=entity_type, entity_id=entity_id).scalar() or f"ID {entity_id}"
+
+def render_item_message(receiver_name, item_name):
+    return f"{receiver_name} received: {item_name}"
+
+def render_hint_message(item_owner_name, location_owner_name, item_name, location_name):
+    return f"{item_owner_name}'s '{item_name}' is in {location_owner_name}'s world at '{location_name}'."
+
+def lookup_entity_names(session, game, checksum, entity_type, entity_ids):
+    """Resolves many ids of one game at once. Ids that are not cached map to 'ID <n>'."""
+    if store := get_datapackage_store(checksum):
+        return {eid: store.lookup(entity_type, eid) or f"ID {eid}" for eid in entity_ids}
+    entity_ids = list(entity_ids)
+    names = {}
+    for i in range(0, len(entity_ids), 500): # Stay well under SQLite's bound parameter limit
+        names.update(session.query(DatapackageCache.entity_id, DatapackageCache.entity_name).filter(
+            DatapackageCache.game == game, DatapackageCache.checksum == checksum,
+            DatapackageCache.entity_type == entity_type, DatapackageCache.entity_id.in_(entity_ids[i:i + 500])
+        ).all())
+    return {eid: names.get(eid, f"ID {eid}") for eid in entity_ids}
+
+_backfill_retry = {} # room_id -> (failures, retry_at) for rooms whose history could not be fully rendered
+
+def defer_backfill(room_id, reason, permanent=False):
+    """Backs off exponentially before the next attempt at a room, or gives up on it until restart if permanent."""
+    failures = _backfill_retry.get(room_id, (0, 0))[0] + 1
+    delay = float('inf') if permanent else min(SUPERVISOR_INTERVAL_SECONDS * 2 ** failures, BACKFILL_MAX_RETRY_SECONDS)
+    _backfill_retry[room_id] = (failures, time.time() + delay)
+    print(f"[BACKFILL] {reason} for room {room_id}. " + ("Giving up until restart." if permanent else f"Retrying in {delay:.0f}s."))
+
+def backfill_rendered_history():
+    """Renders and stores history text for events saved without it: events from before it was stored at write
+    time, and events saved while the room's players could not be fetched. Run periodically by the supervisor.
+    Events whose players are still unknown stay NULL, so they are never stored with placeholder names."""
+    session = Session()
+    try:
+        tracked_rooms = {r.room_id: r for r in session.query(TrackedRoom).all()}
+        pending_room_ids = {r for (r,) in session.query(NotifiedItem.room_id).filter(NotifiedItem.message.is_(None)).distinct()}
+        pending_room_ids |= {r for (r,) in session.query(NotifiedHint.room_id).filter(NotifiedHint.message.is_(None)).distinct()}
+        for room_id in pending_room_ids & tracked_rooms.keys():
+            if time.time() < _backfill_retry.get(room_id, (0, 0))[1]: continue
+            try:
+                response = requests.get(f"{ARCHIPELAGO_API_URL}/room_status/{room_id}", timeout=10)
+                response.raise_for_status()
+                players = response.json().get('players', [])
+            except requests.RequestException as e:
+                status = e.response.status_code if e.response is not None else None
+                defer_backfill(room_id, f"Could not fetch players ({status or e})", permanent=status is not None and 400 <= status < 500)
+                continue
+            name_map = {i + 1: p[0] for i, p in enumerate(players)}
+            game_map = {i + 1: p[1] for i, p in enumerate(players)}
+            game_checksums = json.loads(tracked_rooms[room_id].game_checksums_json)
+            def names_by_game(ids_by_game, entity_type):
+                return {game: lookup_entity_names(session, game, game_checksums.get(game), entity_type, ids) for game, ids in ids_by_game.items()}
+
+            rendered, unresolved, last_id = 0, 0, 0
+            # Paged by id, since unresolved rows stay NULL and would otherwise be selected again
+            while items := session.query(NotifiedItem).filter(NotifiedItem.room_id == room_id, NotifiedItem.message.is_(None), NotifiedItem.id > last_id).order_by(NotifiedItem.id).limit(BACKFILL_BATCH_SIZE).all():
+                last_id = items[-1].id
+                resolvable = [item for item in items if item.receiving_slot_id in name_map]
+                unresolved += len(items) - len(resolvable)
+                item_ids_by_game = {}
+                for item in resolvable: item_ids_by_game.setdefault(game_map[item.receiving_slot_id], set()).add(item.item_id)
+                item_names = names_by_game(item_ids_by_game, 'item')
+                for item in resolvable:
+                    item.receiver_name = name_map[item.receiving_slot_id]
+                    item.receiver_game = game_map[item.receiving_slot_id]
+                    item.item_name = item_names[item.receiver_game][item.item_id]
+                    item.message = render_item_message(item.receiver_name, item.item_name)
+                session.commit()
+                rendered += len(resolvable)
+            last_id = 0
+            while hints := session.query(NotifiedHint).filter(NotifiedHint.room_id == room_id, NotifiedHint.message.is_(None), NotifiedHint.id > last_id).order_by(NotifiedHint.id).limit(BACKFILL_BATCH_SIZE).all():
+                last_id = hints[-1].id
+                resolvable = [hint for hint in hints if hint.item_owner_id in name_map and hint.location_owner_id in name_map]
+                unresolved += len(hints) - len(resolvable)
+                item_ids_by_game, location_ids_by_game = {}, {}
+                for hint in resolvable:
+                    item_ids_by_game.setdefault(game_map[hint.item_owner_id], set()).add(hint.item_id)
+                    location_ids_by_game.setdefault(game_map[hint.location_owner_id], set()).add(hint.location_id)
+                item_names, location_names = names_by_game(item_ids_by_game, 'item'), names_by_game(location_ids_by_game, 'location')
+                for hint in resolvable:
+                    hint.item_owner_name = name_map[hint.item_owner_id]
+                    hint.location_owner_name = name_map[hint.location_owner_id]
+                    hint.item_name = item_names[game_map[hint.item_owner_id]][hint.item_id]
+                    hint.location_name = location_names[game_map[hint.location_owner_id]][hint.location_id]
+                    hint.message = render_hint_message(hint.item_owner_name, hint.location_owner_name, hint.item_name, hint.location_name)
+                session.commit()
+                rendered += len(resolvable)
+            if rendered: print(f"[BACKFILL] Rendered history text for {rendered} events in room {room_id}.")
+            if unresolved: defer_backfill(room_id, f"{unresolved} events belong to slots missing from the player list")
+            else: _backfill_retry.pop(room_id, None)
+    except Exception as e:
+        print(f"[BACKFILL] An error occurred: {e}")
+        session.rollback()
+    finally:
+        Session.remove()
 
 # ==============================================================================
-# 3. FLASK API
+# 3. PROFILING
+# ==============================================================================
+# Profiling is off by default. It is switched on at runtime through PROFILING_CONFIG_FILE
+# (or the loopback-only /debug/profiling endpoint, which writes it), e.g.:
+#   {"rooms": ["<room_id>"], "routes": ["/history/items"], "sample_rate": 0.01, "expires_at": 1767225600}
+# Each profiled poll cycle or request is written to its own folder under PROFILE_DIR, up to PROFILE_MAX_RUNS.
+
+_active_profile = ContextVar('active_profile', default=None)
+_replay_responses = ContextVar('replay_responses', default=None)
+_profiling_config_cache = {'mtime': None, 'config': {}}
+
+def get_profiling_config():
+    """Returns the current profiling config, re-reading the file only when it has changed."""
+    try:
+        mtime = os.path.getmtime(PROFILING_CONFIG_FILE)
+    except OSError:
+        return {}
+    if mtime != _profiling_config_cache['mtime']:
+        try:
+            with open(PROFILING_CONFIG_FILE) as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[PROFILE] Could not read {PROFILING_CONFIG_FILE}. Error: {e}")
+            config = {}
+        _profiling_config_cache.update(mtime=mtime, config=config if isinstance(config, dict) else {})
+    return _profiling_config_cache['config']
+
+def profile_run_count():
+    try:
+        return len(os.listdir(PROFILE_DIR))
+    except OSError:
+        return 0
+
+def should_profile(kind, *names):
+    config = get_profiling_config()
+    if not config: return False
+    if (expires_at := config.get('expires_at')) and time.time() > expires_at: return False
+    targets = config.get('routes' if kind == 'request' else 'rooms', [])
+    sample_rate = config.get('sample_rate', 0)
+    if not any(name in targets for name in names) and not (sample_rate > 0 and random.random() < sample_rate): return False
+    if profile_run_count() >= PROFILE_MAX_RUNS:
+        print(f"[PROFILE] {PROFILE_DIR} already holds {PROFILE_MAX_RUNS} runs. Skipping {kind} '{names[0]}'.")
+        return False
+    return True
+
+class ProfileRun:
+    """Collects cProfile stats, per-stage wall time, SQL counts and upstream responses for one poll cycle or request."""
+    def __init__(self, kind, name, meta=None):
+        self.kind, self.name, self.meta = kind, name, meta or {}
+        self.stages, self.sql_counts, self.upstream = {}, {}, {}
+        self.profiler = None
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.wall_time = None
+
+    def begin(self):
+        # Only one cProfile can be active per thread. Concurrent runs on the same thread (other rooms on the
+        # poller loop) still get stage, SQL and upstream data, just without a call profile.
+        if not getattr(thread_local_data, 'cprofile_active', False):
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+                thread_local_data.cprofile_active = True
+            except ValueError:
+                self.profiler = None
+
+    def end(self):
+        if self.profiler:
+            self.profiler.disable()
+            thread_local_data.cprofile_active = False
+        self.wall_time = time.perf_counter() - self.start
+
+    def add_stage_time(self, stage, elapsed):
+        self.stages[stage] = self.stages.get(stage, 0.0) + elapsed
+
+    def count_statement(self, statement):
+        verb = statement.split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+        self.sql_counts[verb] = self.sql_counts.get(verb, 0) + 1
+
+    def dump(self):
+        safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', self.name).strip('_') or 'root'
+        out_dir = os.path.join(PROFILE_DIR, f"{self.started_at.strftime('%Y%m%d-%H%M%S-%f')}_{self.kind}_{safe_name}")
+        os.makedirs(out_dir, exist_ok=True)
+        if self.profiler:
+            self.profiler.dump_stats(os.path.join(out_dir, 'profile.prof'))
+            with open(os.path.join(out_dir, 'profile.txt'), 'w') as f:
+                pstats.Stats(self.profiler, stream=f).sort_stats('cumulative').print_stats(50)
+        summary = {
+            'kind': self.kind,
+            'name': self.name,
+            'meta': self.meta,
+            'started_at': self.started_at.isoformat(),
+            'wall_time_ms': round(self.wall_time * 1000, 3),
+            'stages_ms': {stage: round(t * 1000, 3) for stage, t in self.stages.items()},
+            'sql_statements': sum(self.sql_counts.values()),
+            'sql_counts': self.sql_counts
+        }
+        with open(os.path.join(out_dir, 'summary.json'), 'w') as f: json.dump(summary, f, indent=2)
+        if self.upstream:
+            with open(os.path.join(out_dir, 'upstream.json'), 'w') as f: json.dump(self.upstream, f)
+        print(f"[PROFILE] {self.kind} '{self.name}' took {summary['wall_time_ms']:.1f} ms with {summary['sql_statements']} SQL statements. Saved to {out_dir}")
+        return out_dir
+
+def start_profile(kind, name, meta=None):
+    run = ProfileRun(kind, name, meta)
+    token = _active_profile.set(run)
+    run.begin()
+    return run, token
+
+def finish_profile(run, token):
+    run.end()
+    _active_profile.reset(token)
+    try:
+        return run.dump()
+    except OSError as e:
+        print(f"[PROFILE] Could not write profile for {run.kind} '{run.name}'. Error: {e}")
+
+@contextmanager
+def profiling(kind, name, meta=None, force=False):
+    """Profiles the enclosed block if the config selects it (or force is set); otherwise a no-op."""
+    if not force and not should_profile(kind, name):
+        yield None
+        return
+    run, token = start_profile(kind, name, meta)
+    try: yield run
+    finally: finish_profile(run, token)
+
+@contextmanager
+def profile_stage(stage):
+    """Adds the wall time of the enclosed block to the named stage of the active profile, if any."""
+    run = _active_profile.get()
+    if run is None:
+        yield
+        return
+    start = time.perf_counter()
+    try: yield
+    finally: run.add_stage_time(stage, time.perf_counter() - start)
+
+def upstream_key(url):
+    # Recorded relative to the API base so a cycle recorded in production replays against any ARCHIPELAGO_API_URL
+    return url[len(ARCHIPELAGO_API_URL):] if url.startswith(ARCHIPELAGO_API_URL) else url
+
+def record_upstream(url, data):
+    if (run := _active_profile.get()) is not None: run.upstream[upstream_key(url)] = data
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    if (run := _active_profile.get()) is not None: run.count_statement(statement)
+
+# ==============================================================================
+# 4. FLASK API
 # ==============================================================================
 
 app = Flask(__name__)
@@ -155,6 +572,17 @@ def log_request_info():
         log_line += f" | Payload: {json.dumps(payload)}"
     print(log_line)
 
+# --- Profiling Middleware ---
+@app.before_request
+def start_request_profile():
+    rule = request.url_rule.rule if request.url_rule else request.path
+    if should_profile('request', request.path, rule):
+        g.profile = start_profile('request', rule, {'method': request.method, 'path': request.path, 'args': request.args.to_dict()})
+
+@app.teardown_request
+def finish_request_profile(exception=None):
+    if profile := g.pop('profile', None): finish_profile(*profile)
+
 # --- Error Handling ---
 def handle_db_errors(f):
     @wraps(f)
@@ -190,7 +618,7 @@ def get_tracked_rooms():
         host = "archipelago.gg" # Default host
 
         try:
-            url = f"https://{ARCHIPELAGO_HOST}/api/room_status/{room.room_id}"
+            url = f"{ARCHIPELAGO_API_URL}/room_status/{room.room_id}"
             response = requests.get(url, timeout=5)
             if response.ok:
                 data = response.json()
@@ -218,7 +646,7 @@ def add_tracked_room():
     if not data or 'room_id' not in data or 'alias' not in data: return jsonify({'error': 'Missing room_id or alias'}), 400
     room_id = data['room_id']
     try:
-        url = f"https://{ARCHIPELAGO_HOST}/api/room_status/{room_id}"
+        url = f"{ARCHIPELAGO_API_URL}/room_status/{room_id}"
         response = requests.get(url, timeout=10)
         if response.status_code >= 400: return jsonify({'error': f'Invalid room (status {response.status_code}).'}), 400
     except requests.RequestException as e: return jsonify({'error': f'Could not validate room: {e}'}), 502
@@ -268,7 +696,7 @@ def get_room_players(room_db_id):
     if not room: return jsonify({'error': 'Room not found'}), 404
     tracked_slot_ids = {slot.slot_id for slot in room.slots}
     try:
-        url = f"https://{ARCHIPELAGO_HOST}/api/room_status/{room.room_id}"
+        url = f"{ARCHIPELAGO_API_URL}/room_status/{room.room_id}"
         response = requests.get(url, timeout=10)
         response.raise_for_status()
         players = response.json().get('players', [])
@@ -290,6 +718,20 @@ def update_tracked_slots(room_db_id):
     session.commit()
     return jsonify({'message': 'Tracked slots updated.'})
 
+def parse_since(query, timestamp_column):
+    since_timestamp = request.args.get('since')
+    if since_timestamp:
+        try:
+            # Parse the ISO 8601 timestamp from the app
+            since_dt = datetime.fromisoformat(since_timestamp.replace('Z', '+00:00'))
+            query = query.filter(timestamp_column > since_dt)
+        except (ValueError, TypeError):
+            pass # Ignore invalid timestamps
+    return query
+
+def format_timestamp(timestamp):
+    return timestamp.replace(tzinfo=timezone.utc).isoformat() if timestamp else None
+
 @app.route('/rooms/<int:room_db_id>/history/items', methods=['GET'])
 @handle_db_errors
 def get_item_history(room_db_id):
@@ -297,56 +739,55 @@ def get_item_history(room_db_id):
     room = session.query(TrackedRoom).filter_by(id=room_db_id).first()
     if not room: return jsonify({'error': 'Room not found'}), 404
     
-    game_checksums = json.loads(room.game_checksums_json)
     tracked_slot_ids = {slot.slot_id for slot in room.slots}
     if not tracked_slot_ids: return jsonify([])
     
-    # --- THIS IS THE UPDATED QUERY LOGIC ---
     query = session.query(NotifiedItem).filter(
         NotifiedItem.room_id == room.room_id, 
         NotifiedItem.receiving_slot_id.in_(tracked_slot_ids)
     )
-    
-    # Check for the 'since' parameter
-    since_timestamp = request.args.get('since')
-    if since_timestamp:
-        try:
-            # Parse the ISO 8601 timestamp from the app
-            since_dt = datetime.fromisoformat(since_timestamp.replace('Z', '+00:00'))
-            query = query.filter(NotifiedItem.timestamp > since_dt)
-        except (ValueError, TypeError):
-            pass # Ignore invalid timestamps
+    query = parse_since(query, NotifiedItem.timestamp)
+
+    with profile_stage('db'):
+        items = query.order_by(NotifiedItem.timestamp.desc(), NotifiedItem.id.desc()).limit(100).all()
+
+    history = [{
+        "message": item.message or render_item_message(f"P{item.receiving_slot_id}", f"ID {item.item_id}"),
+        "timestamp": format_timestamp(item.timestamp),
+        "tracker_id": room.tracker_id,
+        "slot_id": item.receiving_slot_id,
+        "icon_name": room.icon_name
+    } for item in items]
+    return jsonify(history)
 
-    items = query.order_by(NotifiedItem.id.desc()).limit(100).all()
-    # --- END OF QUERY LOGIC UPDATE ---
+@app.route('/rooms/<int:room_db_id>/history/hints', methods=['GET'])
+@handle_db_errors
+def get_hint_history(room_db_id):
+    session = Session()
+    room = session.query(TrackedRoom).filter_by(id=room_db_id).first()
+    if not room: return jsonify({'error': 'Room not found'}), 404
 
-    try:
-        url = f"https://{ARCHIPELAGO_HOST}/api/room_status/{room.room_id}"
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        players = response.json().get('players', [])
-        name_map = {i + 1: p[0] for i, p in enumerate(players)}
-        game_map = {i + 1: p[1] for i, p in enumerate(players)}
-    except requests.RequestException: name_map, game_map = {}, {}
-    
-    history = []
-    for item in items:
-        receiver_name = name_map.get(item.receiving_slot_id, f"P{item.receiving_slot_id}")
-        receiver_game = game_map.get(item.receiving_slot_id, "Unknown")
-        game_checksum = game_checksums.get(receiver_game)
-        
-        item_name = session.query(DatapackageCache.entity_name).filter_by(game=receiver_game, checksum=game_checksum, entity_type='item', entity_id=item.item_id).scalar() or f"ID {item.item_id}"
-        
-        history.append({
-            "message": f"{receiver_name} received: {item_name}",
-            "timestamp": item.timestamp.replace(tzinfo=timezone.utc).isoformat(),
-            "tracker_id": room.tracker_id,
-            "slot_id": item.receiving_slot_id,
-            "icon_name": room.icon_name
-        })
-        
-    return jsonify(history)
+    tracked_slot_ids = {slot.slot_id for slot in room.slots}
+    if not tracked_slot_ids: return jsonify([])
 
+    query = session.query(NotifiedHint).filter(
+        NotifiedHint.room_id == room.room_id,
+        or_(NotifiedHint.item_owner_id.in_(tracked_slot_ids), NotifiedHint.location_owner_id.in_(tracked_slot_ids))
+    )
+    query = parse_since(query, NotifiedHint.timestamp)
+
+    with profile_stage('db'):
+        hints = query.order_by(NotifiedHint.timestamp.desc(), NotifiedHint.id.desc()).limit(100).all()
+
+    history = [{
+        "message": hint.message or render_hint_message(f"P{hint.item_owner_id}", f"P{hint.location_owner_id}", f"ID {hint.item_id}", f"ID {hint.location_id}"),
+        "timestamp": format_timestamp(hint.timestamp),
+        "tracker_id": room.tracker_id,
+        "slot_id": hint.item_owner_id,
+        "location_slot_id": hint.location_owner_id,
+        "icon_name": room.icon_name
+    } for hint in hints]
+    return jsonify(history)
 
 @app.route('/history/items', methods=['GET'])
 @handle_db_errors
@@ -355,99 +796,75 @@ def get_global_item_history():
     all_rooms = session.query(TrackedRoom).all()
     if not all_rooms: return jsonify([])
 
-    filters = []
-    room_data_map = {}
-    for room in all_rooms:
-        try:
+    # One ordered range scan on ix_notified_items_room_time per room, merged here, instead of a single OR query
+    # that SQLite can only answer by collecting every match and sorting it in a temp B-tree.
+    room_streams = []
+    with profile_stage('db'):
+        for room in all_rooms:
             tracked_slot_ids = {slot.slot_id for slot in room.slots}
-            if tracked_slot_ids:
-                filters.append(
-                    (NotifiedItem.room_id == room.room_id) &
-                    (NotifiedItem.receiving_slot_id.in_(tracked_slot_ids))
-                )
-                room_data_map[room.room_id] = {
-                    'db_id': room.id,
-                    'game_checksums': json.loads(room.game_checksums_json),
-                    'tracker_id': room.tracker_id,
-                    'icon_name': room.icon_name
-                }
-        except Exception as e:
-            print(f"[ERROR] Skipping room '{room.alias}' ({room.room_id}) due to a data error: {e}")
-            continue
-
-    if not filters: return jsonify([])
-
-    query = session.query(NotifiedItem).filter(or_(*filters))
-    
-    since_timestamp = request.args.get('since')
-    if since_timestamp:
-        try:
-            since_dt = datetime.fromisoformat(since_timestamp.replace('Z', '+00:00'))
-            query = query.filter(NotifiedItem.timestamp > since_dt)
-        except (ValueError, TypeError): pass
-
-    # --- THE FIX: Remove the .limit(200) from this line ---
-    items = query.order_by(NotifiedItem.id.desc()).all()
-
-    if not items: return jsonify([])
-
-    room_ids_in_history = {item.room_id for item in items}
-    for room_id in room_ids_in_history:
-        try:
-            url = f"https://{ARCHIPELAGO_HOST}/api/room_status/{room_id}"
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            players = response.json().get('players', [])
-            if room_id in room_data_map:
-                room_data_map[room_id]['name_map'] = {i + 1: p[0] for i, p in enumerate(players)}
-                room_data_map[room_id]['game_map'] = {i + 1: p[1] for i, p in enumerate(players)}
-        except requests.RequestException:
-            if room_id in room_data_map:
-                room_data_map[room_id]['name_map'] = {}
-                room_data_map[room_id]['game_map'] = {}
+            if not tracked_slot_ids: continue
+            query = session.query(NotifiedItem).filter(
+                NotifiedItem.room_id == room.room_id,
+                NotifiedItem.receiving_slot_id.in_(tracked_slot_ids)
+            )
+            query = parse_since(query, NotifiedItem.timestamp)
+            items = query.order_by(NotifiedItem.timestamp.desc(), NotifiedItem.id.desc()).all()
+            if items: room_streams.append([(item, room) for item in items])
 
     history = []
-    for item in items:
-        room_data = room_data_map.get(item.room_id)
-        if not room_data: continue
-
-        name_map = room_data.get('name_map', {})
-        game_map = room_data.get('game_map', {})
-        game_checksums = room_data.get('game_checksums', {})
-        tracker_id = room_data.get('tracker_id')
-        icon_name = room_data.get('icon_name')
-        db_id = room_data.get('db_id')
-
-        receiver_name = name_map.get(item.receiving_slot_id, f"P{item.receiving_slot_id}")
-        receiver_game = game_map.get(item.receiving_slot_id, "Unknown")
-        game_checksum = game_checksums.get(receiver_game)
-
-        item_name = session.query(DatapackageCache.entity_name).filter_by(
-            game=receiver_game,
-            checksum=game_checksum,
-            entity_type='item',
-            entity_id=item.item_id
-        ).scalar() or f"ID {item.item_id}"
-
+    newest_first = heapq.merge(*room_streams, key=lambda entry: (entry[0].timestamp or datetime.min, entry[0].id), reverse=True)
+    for item, room in newest_first:
         history.append({
-            "message": f"{receiver_name} received: {item_name}",
-            "timestamp": item.timestamp.replace(tzinfo=timezone.utc).isoformat(),
-            "tracker_id": tracker_id,
+            "message": item.message or render_item_message(f"P{item.receiving_slot_id}", f"ID {item.item_id}"),
+            "timestamp": format_timestamp(item.timestamp),
+            "tracker_id": room.tracker_id,
             "slot_id": item.receiving_slot_id,
-            "icon_name": icon_name,
-            'db_id': db_id
+            "icon_name": room.icon_name,
+            'db_id': room.id
         })
 
     return jsonify(history)
 
+def loopback_only(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.remote_addr not in ('127.0.0.1', '::1'): return jsonify({'error': 'Only available from localhost'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+@app.route('/debug/profiling', methods=['GET'])
+@loopback_only
+def get_profiling():
+    return jsonify(get_profiling_config())
+
+@app.route('/debug/profiling', methods=['PUT'])
+@loopback_only
+def update_profiling():
+    data = request.json
+    if not isinstance(data, dict): return jsonify({'error': 'Expected a JSON object'}), 400
+    try:
+        duration = min(max(int(data.get('duration_seconds', PROFILING_MAX_DURATION_SECONDS)), 0), PROFILING_MAX_DURATION_SECONDS)
+        config = {
+            'rooms': [str(r) for r in data.get('rooms', [])],
+            'routes': [str(r) for r in data.get('routes', [])],
+            'sample_rate': min(max(float(data.get('sample_rate', 0)), 0.0), 1.0),
+            'expires_at': int(time.time()) + duration
+        }
+    except (TypeError, ValueError): return jsonify({'error': 'Invalid profiling config'}), 400
+    with open(PROFILING_CONFIG_FILE, 'w') as f: json.dump(config, f, indent=2)
+    return jsonify({'message': 'Profiling config updated.', 'config': config})
+
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     Session.remove()
 
 # ==============================================================================
-# 4. BACKGROUND POLLER
+# 5. BACKGROUND POLLER
 # ==============================================================================
 async def send_push_notifications(notifications, device_tokens):
+    if _replay_responses.get() is not None:
+        print(f"[REPLAY] Skipping {len(notifications)} push notifications.")
+        return
     firebase_app = get_firebase_app()
     if not firebase_app or not notifications or not device_tokens: return
 
@@ -499,58 +916,69 @@ async def send_push_notifications(notifications, device_tokens):
             await asyncio.sleep(1)
 
 async def fetch_json(url):
+    if (replay := _replay_responses.get()) is not None:
+        data = replay.get(upstream_key(url))
+        record_upstream(url, data)
+        return data
     session = get_aiohttp_session()
     try:
         async with session.get(url, timeout=15) as response:
             response.raise_for_status()
-            return await response.json()
-    except Exception as e: return None
+            data = await response.json()
+    except Exception as e: data = None
+    record_upstream(url, data)
+    return data
 
 async def poll_room_instance(room_info):
     room_id, tracker_id, room_alias = room_info['room_id'], room_info['tracker_id'], room_info['alias']
     timestamp = datetime.now().strftime('%H:%M:%S')
     # print(f"[{timestamp}][{room_alias}] Polling tracker...")
     session = Session()
-    db_room = session.query(TrackedRoom).filter(TrackedRoom.room_id == room_id).first()
-    if not db_room: return
-    game_checksums = json.loads(db_room.game_checksums_json)
-    all_tracked_slots = {slot.slot_id for slot in db_room.slots}
+    with profile_stage('db'):
+        db_room = session.query(TrackedRoom).filter(TrackedRoom.room_id == room_id).first()
+        if not db_room: return
+        game_checksums = json.loads(db_room.game_checksums_json)
+        all_tracked_slots = {slot.slot_id for slot in db_room.slots}
     if not all_tracked_slots: return
-    tracker_data = await fetch_json(f"https://{ARCHIPELAGO_HOST}/api/tracker/{tracker_id}")
-    if not tracker_data: return
-    room_status_data = await fetch_json(f"https://{ARCHIPELAGO_HOST}/api/room_status/{room_id}")
+    with profile_stage('fetch'):
+        tracker_data = await fetch_json(f"{ARCHIPELAGO_API_URL}/tracker/{tracker_id}")
+        if not tracker_data: return
+        room_status_data = await fetch_json(f"{ARCHIPELAGO_API_URL}/room_status/{room_id}")
     players = room_status_data.get('players', []) if room_status_data else []
     name_map = {i + 1: p[0] for i, p in enumerate(players)}
     game_map = {i + 1: p[1] for i, p in enumerate(players)}
-    device_tokens = [d.fcm_token for d in session.query(Device.fcm_token).all()]
-    if not device_tokens: return
+    with profile_stage('db'):
+        device_tokens = [d.fcm_token for d in session.query(Device.fcm_token).all()]
+    if not device_tokens and _replay_responses.get() is None: return
     
     unique_notification_contents = set()
     
     finished_player_ids = set()
-    player_statuses_raw = tracker_data.get('player_status', {})
-    if isinstance(player_statuses_raw, dict):
-        for slot_id_str, status_code in player_statuses_raw.items():
-            slot_id = int(slot_id_str)
-            if slot_id in all_tracked_slots and status_code == 30:
-                finished_player_ids.add(slot_id)
-    elif isinstance(player_statuses_raw, list):
-        for status_info in player_statuses_raw:
-            slot_id, status_code = -1, -1
-            if isinstance(status_info, dict) and 'player' in status_info and 'status' in status_info:
-                slot_id, status_code = status_info['player'], status_info['status']
-            elif isinstance(status_info, (list, tuple)) and len(status_info) >= 2:
-                slot_id, status_code, *_ = status_info
-            
-            if slot_id != -1 and int(slot_id) in all_tracked_slots and status_code == 30:
-                finished_player_ids.add(int(slot_id))
+    with profile_stage('parse'):
+        player_statuses_raw = tracker_data.get('player_status', {})
+        if isinstance(player_statuses_raw, dict):
+            for slot_id_str, status_code in player_statuses_raw.items():
+                slot_id = int(slot_id_str)
+                if slot_id in all_tracked_slots and status_code == 30:
+                    finished_player_ids.add(slot_id)
+        elif isinstance(player_statuses_raw, list):
+            for status_info in player_statuses_raw:
+                slot_id, status_code = -1, -1
+                if isinstance(status_info, dict) and 'player' in status_info and 'status' in status_info:
+                    slot_id, status_code = status_info['player'], status_info['status']
+                elif isinstance(status_info, (list, tuple)) and len(status_info) >= 2:
+                    slot_id, status_code, *_ = status_info
+                
+                if slot_id != -1 and int(slot_id) in all_tracked_slots and status_code == 30:
+                    finished_player_ids.add(int(slot_id))
 
     if finished_player_ids:
-        for slot_id in finished_player_ids:
-            name = name_map.get(slot_id, f"P{slot_id}")
-            unique_notification_contents.add((f"[{room_alias}] 🏁 Player Finished!", f"{name} has finished."))
-            if slot := session.query(TrackedSlot).filter_by(room_id=db_room.id, slot_id=slot_id).first(): session.delete(slot)
-        session.commit()
+        with profile_stage('db'):
+            for slot_id in finished_player_ids:
+                name = name_map.get(slot_id, f"P{slot_id}")
+                unique_notification_contents.add((f"[{room_alias}] 🏁 Player Finished!", f"{name} has finished."))
+                if slot := session.query(TrackedSlot).filter_by(room_id=db_room.id, slot_id=slot_id).first(): session.delete(slot)
+            session.commit()
     
     active_tracked_slots = all_tracked_slots - finished_player_ids
     if not active_tracked_slots:
@@ -558,57 +986,75 @@ async def poll_room_instance(room_info):
             notifications_to_send = [{'title': t, 'body': b} for t, b in unique_notification_contents]
             print(f"[{timestamp}][{room_alias}] Found {len(notifications_to_send)} unique events. Sending notifications to {len(device_tokens)} devices.")
             for n in notifications_to_send: print(f"  - {n['title']} {n['body']}")
-            await send_push_notifications(notifications_to_send, device_tokens)
+            with profile_stage('notify'):
+                await send_push_notifications(notifications_to_send, device_tokens)
         return
 
-    existing_items = {(i.receiving_slot_id, i.item_id, i.location_id) for i in session.query(NotifiedItem).filter_by(room_id=room_id)}
-    existing_hints = {(h.item_owner_id, h.location_owner_id, h.item_id, h.location_id) for h in session.query(NotifiedHint).filter_by(room_id=room_id)}
+    with profile_stage('db'):
+        existing_items = {(i.receiving_slot_id, i.item_id, i.location_id) for i in session.query(NotifiedItem).filter_by(room_id=room_id)}
+        existing_hints = {(h.item_owner_id, h.location_owner_id, h.item_id, h.location_id) for h in session.query(NotifiedHint).filter_by(room_id=room_id)}
     newly_notified_items, newly_notified_hints = [], []
-    for p_items in tracker_data.get('player_items_received', []):
-        rid = p_items.get('player')
-        if rid in active_tracked_slots:
-            for item_id, loc_id, _, flags in p_items.get('items', []):
-                if bool(flags & 1) and (rid, item_id, loc_id) not in existing_items:
-                    r_game = game_map.get(rid, "Unknown")
-                    r_checksum = game_checksums.get(r_game)
-                    i_name = session.query(DatapackageCache.entity_name).filter_by(game=r_game, checksum=r_checksum, entity_type='item', entity_id=item_id).scalar() or f"ID {item_id}"
-                    unique_notification_contents.add((f"[{room_alias}] ✨ Progression Item!", f"{name_map.get(rid, f'P{rid}')} received: {i_name}"))
-                    newly_notified_items.append(NotifiedItem(room_id=room_id, receiving_slot_id=rid, item_id=item_id, location_id=loc_id))
-                    existing_items.add((rid, item_id, loc_id))
-    for p_hints in tracker_data.get('hints', []):
-        for hint_data in p_hints.get('hints', []):
-            io_id, lo_id, loc_id, item_id, *_ = hint_data
-            if (io_id in active_tracked_slots or lo_id in active_tracked_slots) and (io_id, lo_id, item_id, loc_id) not in existing_hints:
-                io_game, lo_game = game_map.get(io_id, "Unknown"), game_map.get(lo_id, "Unknown")
-                io_checksum, lo_checksum = game_checksums.get(io_game), game_checksums.get(lo_game)
-                i_name = session.query(DatapackageCache.entity_name).filter_by(game=io_game, checksum=io_checksum, entity_type='item', entity_id=item_id).scalar() or f"ID {item_id}"
-                l_name = session.query(DatapackageCache.entity_name).filter_by(game=lo_game, checksum=lo_checksum, entity_type='location', entity_id=loc_id).scalar() or f"ID {loc_id}"
+    with profile_stage('diff'):
+        for p_items in tracker_data.get('player_items_received', []):
+            rid = p_items.get('player')
+            if rid in active_tracked_slots:
+                for item_id, loc_id, _, flags in p_items.get('items', []):
+                    if bool(flags & 1) and (rid, item_id, loc_id) not in existing_items:
+                        r_name, r_game = name_map.get(rid, f"P{rid}"), game_map.get(rid, "Unknown")
+                        i_name = lookup_entity_name(session, r_game, game_checksums.get(r_game), 'item', item_id)
+                        message = render_item_message(r_name, i_name)
+                        unique_notification_contents.add((f"[{room_alias}] ✨ Progression Item!", message))
+                        if rid in name_map:
+                            newly_notified_items.append(NotifiedItem(
+                                room_id=room_id, receiving_slot_id=rid, item_id=item_id, location_id=loc_id,
+                                receiver_name=r_name, receiver_game=r_game, item_name=i_name, message=message
+                            ))
+                        else: # Players unknown (room_status failed), so leave the text for the backfill to render
+                            newly_notified_items.append(NotifiedItem(room_id=room_id, receiving_slot_id=rid, item_id=item_id, location_id=loc_id))
+                        existing_items.add((rid, item_id, loc_id))
+        for p_hints in tracker_data.get('hints', []):
+            for hint_data in p_hints.get('hints', []):
+                io_id, lo_id, loc_id, item_id, *_ = hint_data
+                if (io_id in active_tracked_slots or lo_id in active_tracked_slots) and (io_id, lo_id, item_id, loc_id) not in existing_hints:
+                    io_game, lo_game = game_map.get(io_id, "Unknown"), game_map.get(lo_id, "Unknown")
+                    i_name = lookup_entity_name(session, io_game, game_checksums.get(io_game), 'item', item_id)
+                    l_name = lookup_entity_name(session, lo_game, game_checksums.get(lo_game), 'location', loc_id)
                 
-                if io_id in active_tracked_slots:
-                    unique_notification_contents.add((f"[{room_alias}] 🔔 New Hint for {name_map.get(io_id)}!", f"Your '{i_name}' is in {name_map.get(lo_id)}'s world at '{l_name}'."))
+                    if io_id in active_tracked_slots:
+                        unique_notification_contents.add((f"[{room_alias}] 🔔 New Hint for {name_map.get(io_id)}!", f"Your '{i_name}' is in {name_map.get(lo_id)}'s world at '{l_name}'."))
                 
-                if lo_id in active_tracked_slots and io_id != lo_id:
-                    unique_notification_contents.add((f"[{room_alias}] 🔎 Item Hinted in your World!", f"'{i_name}' for {name_map.get(io_id)} is at your location: '{l_name}'."))
-
-                newly_notified_hints.append(NotifiedHint(room_id=room_id, item_owner_id=io_id, location_owner_id=lo_id, item_id=item_id, location_id=loc_id))
-                existing_hints.add((io_id, lo_id, item_id, loc_id))
+                    if lo_id in active_tracked_slots and io_id != lo_id:
+                        unique_notification_contents.add((f"[{room_alias}] 🔎 Item Hinted in your World!", f"'{i_name}' for {name_map.get(io_id)} is at your location: '{l_name}'."))
+
+                    if io_id in name_map and lo_id in name_map:
+                        io_name, lo_name = name_map[io_id], name_map[lo_id]
+                        newly_notified_hints.append(NotifiedHint(
+                            room_id=room_id, item_owner_id=io_id, location_owner_id=lo_id, item_id=item_id, location_id=loc_id,
+                            item_owner_name=io_name, location_owner_name=lo_name, item_name=i_name, location_name=l_name,
+                            message=render_hint_message(io_name, lo_name, i_name, l_name)
+                        ))
+                    else: # Players unknown (room_status failed), so leave the text for the backfill to render
+                        newly_notified_hints.append(NotifiedHint(room_id=room_id, item_owner_id=io_id, location_owner_id=lo_id, item_id=item_id, location_id=loc_id))
+                    existing_hints.add((io_id, lo_id, item_id, loc_id))
                 
-    if newly_notified_items: session.bulk_save_objects(newly_notified_items)
-    if newly_notified_hints: session.bulk_save_objects(newly_notified_hints)
-    if newly_notified_items or newly_notified_hints: session.commit()
+    with profile_stage('db'):
+        if newly_notified_items: session.bulk_save_objects(newly_notified_items)
+        if newly_notified_hints: session.bulk_save_objects(newly_notified_hints)
+        if newly_notified_items or newly_notified_hints: session.commit()
 
     if unique_notification_contents:
         notifications_to_send = [{'title': t, 'body': b} for t, b in unique_notification_contents]
         print(f"[{timestamp}][{room_alias}] Found {len(notifications_to_send)} unique events. Sending notifications to {len(device_tokens)} devices.")
         for n in notifications_to_send: print(f"  - {n['title']} {n['body']}")
-        await send_push_notifications(notifications_to_send, device_tokens)
+        with profile_stage('notify'):
+            await send_push_notifications(notifications_to_send, device_tokens)
     elif not finished_player_ids: 
         # print(f"[{timestamp}][{room_alias}] No new events found.")
         pass
 
 async def setup_and_cache_datapackage(room_id, session):
     try:
-        room_info = await fetch_json(f"https://{ARCHIPELAGO_HOST}/api/room_status/{room_id}")
+        room_info = await fetch_json(f"{ARCHIPELAGO_API_URL}/room_status/{room_id}")
         if not room_info: return None
         tracker_id, port = room_info.get('tracker'), room_info.get('last_port')
         if not tracker_id or not port: return None
@@ -624,10 +1070,12 @@ async def setup_and_cache_datapackage(room_id, session):
         for game, checksum in checksums.items():
             if session.query(DatapackageCache).filter_by(game=game, checksum=checksum).first():
                 print(f"[SETUP][{room_id}] Datapackage for {game} (checksum: {checksum[:8]}...) already cached.")
+                if get_datapackage_store(checksum) is None:
+                    write_datapackage_store_from_cache(session, game, checksum)
                 continue
 
             print(f"[SETUP][{room_id}] Caching new datapackage for {game} (checksum: {checksum[:8]}...)")
-            game_data = await fetch_json(f"https://{ARCHIPELAGO_HOST}/api/datapackage/{checksum}")
+            game_data = await fetch_json(f"{ARCHIPELAGO_API_URL}/datapackage/{checksum}")
             if not game_data: continue
             actual_data = game_data['games'][game] if 'games' in game_data and game in game_data['games'] else game_data
             
@@ -637,6 +1085,9 @@ async def setup_and_cache_datapackage(room_id, session):
             for n, eid in actual_data.get('location_name_to_id', {}).items():
                 if (game, checksum, 'location', eid) not in unique_entries: unique_entries[(game, checksum, 'location', eid)] = DatapackageCache(game=game, checksum=checksum, entity_type='location', entity_id=eid, entity_name=n)
             if unique_entries: session.bulk_save_objects(list(unique_entries.values()))
+            names_by_type = {entity_type: {} for entity_type in ENTITY_TYPES}
+            for entry in unique_entries.values(): names_by_type[entry.entity_type][entry.entity_id] = entry.entity_name
+            write_datapackage_store(checksum, names_by_type)
 
         if room := session.query(TrackedRoom).filter_by(room_id=room_id).first():
             room.game_checksums_json = json.dumps(checksums)
@@ -650,6 +1101,7 @@ async def setup_and_cache_datapackage(room_id, session):
 async def poller_supervisor():
     print("[POLLER] Background polling service starting...")
     running_tasks = {} # Will now store {'task': task_obj, 'data': room_dict}
+    backfill_future = None
 
     while True:
         session = Session()
@@ -670,7 +1122,8 @@ async def poller_supervisor():
                     # Ensure tracker_id is set before starting
                     if not new_data['tracker_id']:
                         print(f"[SUPERVISOR] First time seeing room {room_id}. Performing setup...")
-                        tracker_id = await setup_and_cache_datapackage(room_id, session)
+                        with profiling('setup', room_id, {'room_info': new_data}):
+                            tracker_id = await setup_and_cache_datapackage(room_id, session)
                         if tracker_id:
                             # We need to update the DB AND our in-memory data
                             session.query(TrackedRoom).filter_by(room_id=room_id).update({'tracker_id': tracker_id})
@@ -684,6 +1137,10 @@ async def poller_supervisor():
                     task = asyncio.create_task(poll_room_with_interval(new_data))
                     running_tasks[room_id] = {'task': task, 'data': new_data}
 
+            # --- Render history text missing from older or upstream-failed events, off the event loop ---
+            if backfill_future is None or backfill_future.done():
+                backfill_future = asyncio.get_running_loop().run_in_executor(None, backfill_rendered_history)
+
             # --- Check for deleted rooms ---
             deleted_room_ids = set(running_tasks.keys()) - set(current_rooms_data.keys())
             for room_id in deleted_room_ids:
@@ -701,20 +1158,69 @@ async def poller_supervisor():
 
 async def poll_room_with_interval(room_info):
     while True:
-        try: await poll_room_instance(room_info)
+        try:
+            # cProfile follows the thread, so a profiled cycle also includes other rooms' tasks that run during its awaits.
+            with profiling('poll', room_info['room_id'], {'room_info': room_info}):
+                await poll_room_instance(room_info)
         except asyncio.CancelledError: break
         except Exception as e: print(f"[POLLER][{room_info['alias']}] Unhandled error: {e}")
         await asyncio.sleep(POLLING_INTERVAL_SECONDS)
 
 def run_poller(): asyncio.run(poller_supervisor())
 
+def replay_poll_cycle(profile_dir):
+    """Re-runs a recorded poll cycle against a copy of the local database using the upstream responses saved with its profile."""
+    summary_path, upstream_path = os.path.join(profile_dir, 'summary.json'), os.path.join(profile_dir, 'upstream.json')
+    # A cycle that returned before fetching anything (e.g. no tracked slots) has a summary but no upstream.json
+    if not os.path.isfile(summary_path) or not os.path.isfile(upstream_path):
+        print(f"[REPLAY] {profile_dir} is not a recorded poll cycle.")
+        return
+    with open(summary_path) as f: summary = json.load(f)
+    with open(upstream_path) as f: upstream = json.load(f)
+    room_info = summary.get('meta', {}).get('room_info')
+    if summary.get('kind') not in ('poll', 'replay') or not room_info:
+        print(f"[REPLAY] {profile_dir} is not a recorded poll cycle.")
+        return
+    print(f"[REPLAY] Replaying poll cycle for room '{room_info['alias']}' with {len(upstream)} recorded responses.")
+
+    async def replay():
+        token = _replay_responses.set(upstream)
+        try:
+            with profiling('replay', room_info['room_id'], {'room_info': room_info, 'source': profile_dir}, force=True):
+                await poll_room_instance(room_info)
+        finally:
+            _replay_responses.reset(token)
+            Session.remove()
+
+    # The cycle's writes go to a throwaway copy, so the real database is untouched and the replay is repeatable.
+    # (pysqlite does not honour the SAVEPOINTs a rolled-back outer transaction would need.)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        replay_db = os.path.join(tmp_dir, 'replay.db')
+        source, target = sqlite3.connect(DATABASE_FILE), sqlite3.connect(replay_db)
+        try: source.backup(target)
+        finally:
+            source.close()
+            target.close()
+        replay_engine = create_engine(f"sqlite:///{replay_db}", connect_args={"check_same_thread": False, "timeout": 30})
+        Session.remove()
+        Session.configure(bind=replay_engine)
+        try: asyncio.run(replay())
+        finally:
+            Session.configure(bind=engine)
+            replay_engine.dispose()
+
 # ==============================================================================
-# 5. MAIN EXECUTION
+# 6. MAIN EXECUTION
 # ==============================================================================
 
 if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "replay":
+        replay_poll_cycle(sys.argv[2])
+        sys.exit(0)
     print("[MAIN] AP Tracker Service starting...")
     Base.metadata.create_all(engine)
+    migrate_schema()
+    build_missing_datapackage_stores()
     print("[MAIN] Database tables verified/created.")
     api_thread = Thread(target=lambda: serve(app, host='0.0.0.0', port=5000), daemon=True)
     api_thread.start()
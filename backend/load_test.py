@@ -0,0 +1,365 @@
+# load_test.py
+# Load-test harness for the AP Tracker API.
+# Generates a synthetic SQLite database, stubs the Archipelago web API with a local fake, and drives
+# the same endpoints the Android app's ApiService calls against a separate API server process.
+#
+# Usage:
+#   python load_test.py generate --db loadtest.db
+#   python load_test.py run --db loadtest.db --output report.json
+#   python load_test.py compare baseline.json report.json
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import socket
+import sqlite3
+import argparse
+import subprocess
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOM_ID_PREFIX = "loadtest"
+INSERT_CHUNK_SIZE = 50000
+
+# Relative weights of each call, roughly matching how the Android app uses ApiService
+WORKLOAD = [
+    ('GET /rooms', 3),
+    ('GET /rooms/<id>/history/items', 5),
+    ('GET /rooms/<id>/history/items?since', 10),
+    ('GET /history/items?since', 10),
+    ('GET /history/items', 1),
+    ('GET /rooms/<id>/players', 2),
+]
+
+# ==============================================================================
+# 1. SYNTHETIC DATA
+# ==============================================================================
+
+def room_id_for(index): return f"{ROOM_ID_PREFIX}{index:05d}"
+
+def synthetic_players(room_index, games):
+    """Deterministic player list for a room, shared by the generator and the fake upstream."""
+    rng = random.Random(room_index)
+    return [[f"Player{room_index}_{slot}", rng.choice(games)] for slot in range(1, rng.randint(2, 30) + 1)]
+
+def synthetic_games(count): return [f"Game {n}" for n in range(count)]
+
+def checksum_for(game): return hashlib.sha1(game.encode()).hexdigest()
+
+def insert_chunked(conn, sql, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= INSERT_CHUNK_SIZE:
+            conn.executemany(sql, chunk)
+            chunk.clear()
+    if chunk: conn.executemany(sql, chunk)
+
+def generate_database(args):
+    if os.path.exists(args.db):
+        if not args.force:
+            print(f"[GENERATE] {args.db} already exists. Use --force to overwrite.")
+            return
+        os.remove(args.db)
+
+    # Create the schema from the real models so the synthetic database matches the service exactly
+    os.environ['AP_TRACKER_DATABASE'] = os.path.abspath(args.db)
+    sys.path.insert(0, BACKEND_DIR)
+    import ap_tracker
+    ap_tracker.Base.metadata.create_all(ap_tracker.engine)
+    ap_tracker.engine.dispose()
+
+    rng = random.Random(args.seed)
+    games = synthetic_games(args.games)
+    checksums = {game: checksum_for(game) for game in games}
+    room_players = {i: synthetic_players(i, games) for i in range(args.rooms)}
+    started = time.perf_counter()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+
+    print(f"[GENERATE] Writing {args.rooms} rooms...")
+    for i, players in room_players.items():
+        room_checksums = {p[1]: checksums[p[1]] for p in players}
+        cursor = conn.execute(
+            "INSERT INTO tracked_rooms (room_id, alias, tracker_id, icon_name, game_checksums_json) VALUES (?, ?, ?, ?, ?)",
+            (room_id_for(i), f"Load Test {i}", f"tracker{i:05d}", "default_icon", json.dumps(room_checksums))
+        )
+        tracked = rng.sample(range(1, len(players) + 1), k=min(len(players), rng.randint(1, 4)))
+        conn.executemany("INSERT INTO tracked_slots (room_id, slot_id) VALUES (?, ?)", [(cursor.lastrowid, s) for s in tracked])
+    conn.executemany("INSERT INTO devices (fcm_token) VALUES (?)", [(f"loadtest-token-{n}",) for n in range(args.devices)])
+
+    print(f"[GENERATE] Writing {args.games * args.entities_per_game * 2} datapackage rows...")
+    insert_chunked(conn,
+        "INSERT INTO datapackage_cache (game, checksum, entity_type, entity_id, entity_name) VALUES (?, ?, ?, ?, ?)",
+        ((game, checksums[game], entity_type, eid, f"{game} {entity_type.title()} {eid}")
+         for game in games for entity_type in ('item', 'location') for eid in range(1, args.entities_per_game + 1))
+    )
+
+    # Timestamps increase with the row id, as they do in production, spread over the last --days days
+    now = datetime.utcnow()
+    def timestamp_at(n, total): return (now - timedelta(days=args.days) + timedelta(days=args.days) * n / total).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+    print(f"[GENERATE] Writing {args.items} notified items...")
+    def item_rows():
+        for n in range(args.items):
+            room_index = rng.randrange(args.rooms)
+            players = room_players[room_index]
+            slot = rng.randint(1, len(players))
+            item_id = rng.randint(1, args.entities_per_game)
+            item_name = f"{players[slot - 1][1]} Item {item_id}"
+            yield (room_id_for(room_index), slot, item_id, n + 1, timestamp_at(n, args.items),
+                   players[slot - 1][0], players[slot - 1][1], item_name, f"{players[slot - 1][0]} received: {item_name}")
+    insert_chunked(conn,
+        "INSERT INTO notified_items (room_id, receiving_slot_id, item_id, location_id, timestamp, receiver_name, receiver_game, item_name, message) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        item_rows()
+    )
+
+    print(f"[GENERATE] Writing {args.hints} notified hints...")
+    def hint_rows():
+        for n in range(args.hints):
+            room_index = rng.randrange(args.rooms)
+            players = room_players[room_index]
+            io_id, lo_id = rng.randint(1, len(players)), rng.randint(1, len(players))
+            io_name, lo_name = players[io_id - 1][0], players[lo_id - 1][0]
+            item_name, location_name = f"{players[io_id - 1][1]} Item {n}", f"{players[lo_id - 1][1]} Location {n}"
+            yield (room_id_for(room_index), io_id, lo_id, n + 1, n + 1, timestamp_at(n, args.hints),
+                   io_name, lo_name, item_name, location_name, f"{io_name}'s '{item_name}' is in {lo_name}'s world at '{location_name}'.")
+    insert_chunked(conn,
+        "INSERT INTO notified_hints (room_id, item_owner_id, location_owner_id, item_id, location_id, timestamp, item_owner_name, location_owner_name, item_name, location_name, message) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        hint_rows()
+    )
+
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    with open(f"{args.db}.json", 'w') as f:
+        json.dump({'rooms': args.rooms, 'games': args.games, 'days': args.days, 'items': args.items, 'hints': args.hints,
+                   'entities_per_game': args.entities_per_game, 'seed': args.seed}, f, indent=2)
+    print(f"[GENERATE] Done in {time.perf_counter() - started:.1f}s. Database: {args.db}")
+
+# ==============================================================================
+# 2. FAKE UPSTREAM
+# ==============================================================================
+
+def start_fake_upstream(games, latency_ms):
+    """Serves /api/room_status/<room_id> for synthetic rooms on a local port."""
+    class FakeArchipelagoHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency_ms / 1000)
+            prefix = f"/api/room_status/{ROOM_ID_PREFIX}"
+            if not self.path.startswith(prefix) or not self.path[len(prefix):].isdigit():
+                self.send_error(404)
+                return
+            room_index = int(self.path[len(prefix):])
+            body = json.dumps({
+                'players': synthetic_players(room_index, games),
+                'last_port': 38281,
+                'tracker': f"tracker{room_index:05d}"
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeArchipelagoHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_api_server(db_path, upstream_url, port):
+    """Runs the API alone in its own process, the same way ap_tracker.wsgi does (no poller)."""
+    env = dict(os.environ, AP_TRACKER_DATABASE=os.path.abspath(db_path), AP_TRACKER_ARCHIPELAGO_API_URL=upstream_url)
+    # Output goes to a file rather than a pipe: nothing reads a pipe during the run, and once it fills, waitress
+    # blocks writing its queue-depth warnings and the report measures the harness instead of the API.
+    log_path = f"{db_path}.server.log"
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen(
+            [sys.executable, '-c', f"from ap_tracker import app; from waitress import serve; serve(app, host='127.0.0.1', port={port})"],
+            cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            with open(log_path) as log: raise RuntimeError(f"API server exited early: {log.read()[-4000:]}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1): return process
+        except OSError: time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"API server did not start within 30 seconds. See {log_path}.")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# ==============================================================================
+# 3. WORKLOAD & REPORTING
+# ==============================================================================
+
+def percentile(sorted_values, pct):
+    if not sorted_values: return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))]
+
+def build_request(name, base_url, room_db_ids, days, rng):
+    room = rng.choice(room_db_ids)
+    # 'since' mirrors the app's incremental refresh: only recent events are requested
+    since = (datetime.utcnow() - timedelta(days=days) * rng.uniform(0.0, 0.05)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return {
+        'GET /rooms': (f"{base_url}/rooms", None),
+        'GET /rooms/<id>/history/items': (f"{base_url}/rooms/{room}/history/items", None),
+        'GET /rooms/<id>/history/items?since': (f"{base_url}/rooms/{room}/history/items", {'since': since}),
+        'GET /history/items?since': (f"{base_url}/history/items", {'since': since}),
+        'GET /history/items': (f"{base_url}/history/items", None),
+        'GET /rooms/<id>/players': (f"{base_url}/rooms/{room}/players", None),
+    }[name]
+
+def run_worker(worker_id, base_url, room_db_ids, days, deadline, timeout, results, lock):
+    rng = random.Random(worker_id)
+    names, weights = zip(*WORKLOAD)
+    http = requests.Session()
+    local_results = []
+    while time.time() < deadline:
+        name = rng.choices(names, weights)[0]
+        url, params = build_request(name, base_url, room_db_ids, days, rng)
+        start = time.perf_counter()
+        try:
+            status = http.get(url, params=params, timeout=timeout).status_code
+        except requests.RequestException:
+            status = None
+        local_results.append((name, status, time.perf_counter() - start))
+    with lock: results.extend(local_results)
+
+def summarize(results, duration):
+    by_endpoint = {}
+    for name, status, latency in results: by_endpoint.setdefault(name, []).append((status, latency))
+    by_endpoint['ALL'] = [(status, latency) for _, status, latency in results]
+
+    summary = {}
+    for name, samples in by_endpoint.items():
+        if not samples: continue
+        latencies = sorted(latency for _, latency in samples)
+        summary[name] = {
+            'requests': len(samples),
+            'throughput_rps': round(len(samples) / duration, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'rate_503': round(sum(1 for status, _ in samples if status == 503) / len(samples), 4),
+            'error_rate': round(sum(1 for status, _ in samples if status is None or status >= 400) / len(samples), 4)
+        }
+    return summary
+
+def print_summary(summary):
+    print(f"{'endpoint':<40} {'requests':>9} {'rps':>9} {'p50 ms':>9} {'p99 ms':>9} {'503':>7} {'errors':>7}")
+    for name, s in summary.items():
+        print(f"{name:<40} {s['requests']:>9} {s['throughput_rps']:>9.2f} {s['p50_ms']:>9.2f} {s['p99_ms']:>9.2f} {s['rate_503']:>7.2%} {s['error_rate']:>7.2%}")
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_load_test(args):
+    if not os.path.exists(args.db):
+        print(f"[RUN] {args.db} does not exist. Run 'python load_test.py generate' first.")
+        return
+    with open(f"{args.db}.json") as f: dataset = json.load(f)
+    with sqlite3.connect(args.db) as conn:
+        room_db_ids = [row[0] for row in conn.execute("SELECT id FROM tracked_rooms")]
+
+    upstream = start_fake_upstream(synthetic_games(dataset['games']), args.upstream_latency_ms)
+    upstream_url = f"http://127.0.0.1:{upstream.server_address[1]}/api"
+    port = free_port()
+    server = start_api_server(args.db, upstream_url, port)
+    base_url = f"http://127.0.0.1:{port}"
+    print(f"[RUN] API server on {base_url} (log: {args.db}.server.log), fake upstream on {upstream_url}. {args.clients} clients for {args.duration}s...")
+
+    results, lock = [], threading.Lock()
+    try:
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            workers = [pool.submit(run_worker, worker_id, base_url, room_db_ids, dataset['days'], start + args.duration, args.timeout, results, lock)
+                       for worker_id in range(args.clients)]
+            for worker in workers: worker.result()
+        duration = time.time() - start
+    finally:
+        server.terminate()
+        server.wait()
+        upstream.shutdown()
+
+    report = {
+        'revision': git_revision(),
+        'started_at': datetime.fromtimestamp(start).isoformat(),
+        'duration_s': round(duration, 2),
+        'clients': args.clients,
+        'upstream_latency_ms': args.upstream_latency_ms,
+        'dataset': dataset,
+        'endpoints': summarize(results, duration)
+    }
+    print_summary(report['endpoints'])
+    if args.output:
+        with open(args.output, 'w') as f: json.dump(report, f, indent=2)
+        print(f"[RUN] Report written to {args.output}")
+
+def compare_reports(args):
+    with open(args.baseline) as f: baseline = json.load(f)
+    with open(args.candidate) as f: candidate = json.load(f)
+    print(f"Baseline: {baseline.get('revision')}  Candidate: {candidate.get('revision')}")
+    print(f"{'endpoint':<40} {'rps':>18} {'p50 ms':>20} {'p99 ms':>20} {'503':>16}")
+    for name, new in candidate['endpoints'].items():
+        old = baseline['endpoints'].get(name)
+        if not old:
+            print(f"{name:<40} (not in baseline)")
+            continue
+        def delta(key):
+            change = f"{(new[key] - old[key]) / old[key]:+.0%}" if old[key] else "n/a"
+            return f"{old[key]:>8} -> {new[key]:<8} {change:>5}"
+        print(f"{name:<40} {delta('throughput_rps')} {delta('p50_ms')} {delta('p99_ms')} {old['rate_503']:>6.2%} -> {new['rate_503']:.2%}")
+
+# ==============================================================================
+# 4. MAIN EXECUTION
+# ==============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the AP Tracker API against a synthetic database.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help="Generate a synthetic database")
+    generate.add_argument('--db', default='loadtest.db')
+    generate.add_argument('--rooms', type=int, default=300)
+    generate.add_argument('--games', type=int, default=200)
+    generate.add_argument('--entities-per-game', type=int, default=1000, help="Items and locations per game in the datapackage cache")
+    generate.add_argument('--items', type=int, default=2000000)
+    generate.add_argument('--hints', type=int, default=500000)
+    generate.add_argument('--devices', type=int, default=20)
+    generate.add_argument('--days', type=int, default=90, help="Time span covered by the generated history")
+    generate.add_argument('--seed', type=int, default=1)
+    generate.add_argument('--force', action='store_true')
+
+    run = commands.add_parser('run', help="Run concurrent client workloads against the API")
+    run.add_argument('--db', default='loadtest.db')
+    run.add_argument('--clients', type=int, default=16)
+    run.add_argument('--duration', type=int, default=60, help="Seconds to run the workload")
+    run.add_argument('--timeout', type=float, default=30, help="Per-request timeout in seconds")
+    run.add_argument('--upstream-latency-ms', type=int, default=50, help="Latency added by the fake Archipelago API")
+    run.add_argument('--output', help="Write the JSON report here for later comparison")
+
+    compare = commands.add_parser('compare', help="Compare two JSON reports")
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+
+    args = parser.parse_args()
+    {'generate': generate_database, 'run': run_load_test, 'compare': compare_reports}[args.command](args)